@@ -3,7 +3,8 @@ OneLambda Fusion access module
 '''
 import json
 import pypyodbc
-import pandas as pd
+from sql_db import SqlConnect
+from vendor_query import fusion_bead_sql, fusion_to_luminosity
 
 
 # ## Todo
@@ -66,74 +67,20 @@ def read_data_from_fusion(patient_local_id, **kwargs):
     '''
     extract bead values from fusion given a unique patient_local_id
     '''
-    #Luminex kit types
-    kittype = kwargs.get('kittype', '').upper()
-    if kittype == 'LSM':
-        kittype = 't.CatalogID like \'LSM%\' and'
-    elif kittype == 'SAB':
-        ab_class = kwargs.get('_class', '_')
-        if ab_class in [1, 2, '1', '2']:
-            kittype = f't.CatalogID like \'LS{ab_class}A%\' and'
-        else:
-            kittype = f't.CatalogID like \'LS_A%\' and'    
-    elif kittype == 'PRA':
-        ab_class = kwargs.get('_class', '_')
-        if ab_class in [1, 2, '1', '2']:
-            kittype = f't.CatalogID like \'LS{ab_class}PRA%\' and'
-        else:
-            kittype = f't.CatalogID like \'LS_PRA%\' and'
-            
-    #limit the date range of the results
-    session_date = kwargs.get('date_range', '')
-    if session_date:
-        session_date = f'and t.AddDT >= \'{session_date[0]}\' and t.AddDT < \'{session_date[1]}\''
-    
-    sql = f'''
-        select  
-
-                p.patientid as patient_id
-                ,t.trayidname as session_name
-                ,s.sampleidname as sample_name      
-                ,t.catalogid as catalog_id
-                ,d.beadid as bead_id
-                ,replace(
-                    replace(
-                        convert(nvarchar(100), pd.specabbr), '-,',''
-                        ), ',-', ''
-                    ) as ab_sero
-                ,replace(
-                    replace(
-                        convert(nvarchar(100), pd.specificity), '-,', ''
-                        ), ',-', ''
-                    ) as ab_mol
-                ,d.rawdata as raw_value
-                ,d.normalvalue as baseline_value
-
-        from 
-
-            patient as p
-
-                join sample as s on s.PatientID = p.PatientID
-                join well as w on w.SampleID = s.SampleID
-                join tray as t on t.TrayID = w.TrayID
-                join well_detail as d on d.WellID = w.WellID
-                join product_detail as pd on pd.BeadID = d.BeadID 
-                                         and t.CatalogID = pd.CatalogID
-        where 
-            {kittype}
-            p.patientid ='{patient_local_id}'
-            {session_date}
-            
-        order by 
-
-            s.shipmentdt
-
-        '''
-        
-    return pd.read_sql_query(sql, con=con)
-
-
-con = connect_to_fusion(fusion_connection_string(read_fusion_connection_json()))
+    sql = fusion_bead_sql(patient_local_id, **kwargs)
+    return fusion_db.read_sql_query(sql)
+
+
+def read_luminosity_from_fusion(patient_local_id, **kwargs):
+    '''
+    extract bead values from fusion given a unique patient_local_id
+    as Luminosity objects, returns a dict keyed by session name
+    '''
+    return fusion_to_luminosity(read_data_from_fusion(patient_local_id, **kwargs))
+
+
+#queries go through SqlConnect for its retry, timeout and breaker policy
+fusion_db = SqlConnect('fusion_settings.json')
 
 
 # d = read_data_from_fusion(patient_local_id=7766
@@ -0,0 +1,148 @@
+'''
+Local sqlite mirror of the OneLambda Fusion bead data
+'''
+import sqlite3
+import pandas as pd
+from vendor_query import fusion_mirror_sql, catalog_filter
+
+MIRROR_COLUMNS = ['well_id', 'bead_id', 'patient_id', 'session_name',
+                  'sample_name', 'catalog_id', 'ab_sero', 'ab_mol',
+                  'raw_value', 'baseline_value', 'add_dt']
+
+MIRROR_SCHEMA = '''
+    create table if not exists bead_data (
+        well_id integer,
+        bead_id integer,
+        patient_id text,
+        session_name text,
+        sample_name text,
+        catalog_id text,
+        ab_sero text,
+        ab_mol text,
+        raw_value real,
+        baseline_value real,
+        add_dt text,
+        primary key (well_id, bead_id));
+    create index if not exists bead_data_patient
+        on bead_data (patient_id, add_dt);
+    create table if not exists sync_state (
+        name text primary key,
+        value text);
+'''
+
+#sortable text and unambiguous for SQL Server datetime
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class FusionMirror:
+    '''
+    Keep a local sqlite copy of the fusion bead values of all patients
+    FusionMirror.watermark: property, AddDT of the newest mirrored tray
+    FusionMirror.sync(): function, pull trays added since the watermark
+    FusionMirror.read_data(): function, bead values of one patient
+    FusionMirror.close(): function, close the mirror database
+    '''
+    def __init__(self, mirror_file='fusion_mirror.db'):
+        self.mirror_file = mirror_file
+        self.__connection = sqlite3.connect(mirror_file)
+        self.__connection.executescript(MIRROR_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def watermark(self):
+        '''
+        return the AddDT watermark as text, None before the first sync
+        '''
+        row = self.__connection.execute(
+            'select value from sync_state where name = ?',
+            ('watermark',)).fetchone()
+        return row[0] if row else None
+
+    def __upsert(self, chunk):
+        '''
+        helper function: insert or replace one chunk of rows and move
+        the watermark on in the same sqlite transaction
+        '''
+        chunk = chunk[MIRROR_COLUMNS].copy()
+        chunk['add_dt'] = pd.to_datetime(chunk['add_dt']) \
+                            .dt.strftime(DATE_FORMAT).str[:-3]
+        chunk = chunk.astype(object).where(chunk.notnull(), None)
+        placeholders = ', '.join('?' * len(MIRROR_COLUMNS))
+        with self.__connection:
+            self.__connection.executemany(
+                f'insert or replace into bead_data '
+                f'({", ".join(MIRROR_COLUMNS)}) values ({placeholders})',
+                chunk.itertuples(index=False, name=None))
+            self.__connection.execute(
+                'insert or replace into sync_state values (?, ?)',
+                ('watermark', chunk['add_dt'].max()))
+
+    def sync(self, fusion_db, chunksize=50000):
+        '''
+        pull the bead values of trays added at or after the watermark
+        from fusion through a SqlConnect (e.g. fusion.fusion_db) in
+        chunks and upsert them locally, rows are keyed on well and
+        bead so re-reading the trays at the watermark does not
+        duplicate them, an interrupted sync resumes from the last
+        chunk written
+        returns the number of rows pulled
+        '''
+        watermark = self.watermark
+        params = [watermark] if watermark else None
+        rows = 0
+        for chunk in fusion_db.read_sql_query(fusion_mirror_sql(watermark),
+                                              params=params,
+                                              chunksize=chunksize):
+            if chunk.empty:
+                continue
+            self.__upsert(chunk)
+            rows += len(chunk)
+        return rows
+
+    def read_data(self, patient_local_id, **kwargs):
+        '''
+        extract bead values of a patient from the mirror, takes the
+        same kittype, _class and date_range keyword arguments as
+        fusion.read_data_from_fusion
+        '''
+        where = ['patient_id = ?']
+        params = [str(patient_local_id)]
+        kittype = catalog_filter('catalog_id', **kwargs)
+        if kittype:
+            where.append(kittype)
+        session_date = kwargs.get('date_range', '')
+        if session_date:
+            where.append('add_dt >= ? and add_dt < ?')
+            params.extend(session_date)
+        sql = (f'select * from bead_data where {" and ".join(where)} '
+               f'order by add_dt, well_id, bead_id')
+        return pd.read_sql_query(sql, con=self.__connection, params=params)
+
+    def close(self):
+        '''
+        close the mirror database
+        '''
+        self.__connection.close()
+        return True
+
+
+def sync_fusion_mirror(mirror_file='fusion_mirror.db',
+                       settings_json='fusion_settings.json', chunksize=50000):
+    '''
+    nightly job: bring the local mirror up to date with fusion
+    returns the number of rows pulled
+    '''
+    #imported here so the mirror can be read without pypyodbc
+    from sql_db import SqlConnect
+
+    fusion_db = SqlConnect(settings_json)
+    try:
+        with FusionMirror(mirror_file) as mirror:
+            return mirror.sync(fusion_db, chunksize=chunksize)
+    finally:
+        fusion_db.close()
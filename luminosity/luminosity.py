@@ -23,8 +23,13 @@
     * Add 'sanity check' to prevent merging data from different lots/kits
 '''
 
+import contextlib
 import csv
 import enum
+import locale
+import os
+import weakref
+import numpy as np
 import pandas as pd
 from pandas import Series, DataFrame
 
@@ -42,6 +47,63 @@ METAINFO = enum.Enum('METAINFO',
 
 __version__ = '0.2.3'
 
+#same default text encoding open() uses for reading the csv files
+ENCODING = locale.getpreferredencoding(False)
+
+class MetaDict(dict):
+    '''
+        dict of meta data reporting every change to a callback as a
+        list of (key, old value, key existed) so edits such as
+        obj.meta['Operator'] = 'X' or obj.meta.update(...) can be undone
+    '''
+    def __init__(self, *args, on_change=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_change = on_change
+
+    def __report(self, keys):
+        if self.on_change is not None and keys:
+            self.on_change([(key, self.get(key), key in self) for key in keys])
+
+    def __setitem__(self, key, value):
+        self.__report([key])
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        if key in self:
+            self.__report([key])
+        super().__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        self.__report(list(items))
+        super().update(items)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            self.__report([key])
+        return super().pop(key, *default)
+
+    def popitem(self):
+        if self:
+            self.__report([next(reversed(self))])
+        return super().popitem()
+
+    def clear(self):
+        self.__report(list(self))
+        super().clear()
+
+#well position at the end of a location label e.g. '5 (A12)' --> 'A12'
+WELL_PATTERN = r'([A-Z]+[0-9]+)\)?\s*$'
+
 class Luminosity:
 
     __doc__ = ('''
@@ -65,8 +127,19 @@ class Luminosity:
             Methods:
             --------
                 get_neta()    : Return meta when given a name
+                get_well()    : Return the rows of a well position
+                get_sample()  : Return the rows of a sample name
+                get_bead()    : Return the readings of a bead
+                refresh()     : Register edits made directly to data
                 update_from() : Update selected rows with new data
                 merge_with()  : Merge current file with another csv file
+                diff()        : Compare with another object or csv file
+                to_long()     : Generate the data as tidy dataframes
+                iter_records(): Generate the data as tidy records
+                undo()        : Revert the last change
+                commit()      : Discard the edit log, keeping the changes
+                rollback()    : Revert all changes
+                transaction() : Group changes into one undo step
                 output()      : Write the changes to a csv file
 
             Exampls:
@@ -79,9 +152,21 @@ class Luminosity:
 
         self.file_name = filename
 
-        with open(filename, 'r') as handle:
+        with open(filename, 'rb') as handle:
             #open the file and convert into a list in memory
-            self.__csv_data = list(csv.reader(handle.readlines()))
+            lines = handle.read().splitlines(keepends=True)
+            reader = csv.reader(line.decode(ENCODING) for line in lines)
+            self.__csv_data = []
+            record_ends = [0]
+            for row in reader:
+                self.__csv_data.append(row)
+                #a quoted field may span several lines
+                record_ends.append(reader.line_num)
+
+            #byte offset of every csv record, used to copy unmodified
+            #sections straight from this file when writing output
+            line_offsets = np.cumsum([0] + [len(line) for line in lines])
+            self.__offsets = line_offsets[record_ends]
 
             #find the where every "DataType:" chunck locates
             self.__datatypes = self.__locate_data_types()
@@ -99,6 +184,60 @@ class Luminosity:
             #get meta data
             self.__meta = self.__meta_info()
 
+            #remember the parsed state to tell modified sections apart
+            self.__source = self.__source_snapshot(filename)
+
+            #lookup indexes are built on first use
+            self.__index = None
+
+            #edit log of changes that can be undone
+            self.__log = []
+            self.__transaction = None
+
+    @classmethod
+    def from_data(cls, data, meta=None, filename='luminosity.csv'):
+        '''
+            Create a Luminosity object from data blocks that did not come
+            from a csv file e.g. bead values read from a database
+            data : DataFrame with 'DataType' and 'Location' as MultiIndex
+                   and 'Sample', bead labels, 'Total Events' and a blank
+                   column, the same layout as Luminosity.data
+            meta : dict of METAINFO names and values, missing ones are blank
+            Example:
+            --------
+            Luminosity.from_data(dframe, meta={'Session': 'TRAY01'})
+        '''
+        meta = meta or {}
+        obj = cls.__new__(cls)
+        obj.file_name = filename
+
+        #rebuild the header rows the csv parser would have read
+        header = []
+        for item in METAINFO:
+            if item.name == 'Date':
+                date = (meta.get('Date') or ' ').split(' ', 1)
+                header.append(['Date'] + date + [''] * (2 - len(date)))
+            else:
+                header.append([item.name, meta.get(item.name, '')])
+        obj.__csv_data = header
+        obj.__header = header
+
+        #position the data blocks as they would be in a csv file
+        dtnames = data.index.get_level_values(0).unique().tolist()
+        obj.__sample_num = len(data.loc[dtnames[0]])
+        block_rows = obj.__sample_num + 3
+        obj.__datatypes = Series([len(header) + i * block_rows
+                                  for i in range(len(dtnames))], index=dtnames)
+
+        #the object is edited in place, keep the caller's frame intact
+        obj.__data = data.copy()
+        obj.__meta = obj.__meta_info()
+        obj.__source = None
+        obj.__index = None
+        obj.__log = []
+        obj.__transaction = None
+        return obj
+
     ######################### PRIVATE METHODS #####################
 
     def __locate_data_types(self):
@@ -214,9 +353,10 @@ class Luminosity:
         '''
             Return a dict containing all meta info
         '''
-        data_dict = {}
+        data_dict = MetaDict(on_change=self.__meta_changed)
         for meta in METAINFO:
-            data_dict[meta.name] = self.__get_meta_info(meta.name)
+            dict.__setitem__(data_dict, meta.name,
+                             self.__get_meta_info(meta.name))
         return data_dict
 
     def __get_meta_info(self, name=None):
@@ -310,14 +450,121 @@ class Luminosity:
             Reconstruct the main body of csv with data for all datatypes
         '''
         text = ''
-        for idx in self.__data.index.levels[0]:
-            text += '\"DataType:\",\"{}\"\r\n'.format(idx)
-            text += self.__data.loc[idx].to_csv(line_terminator='\r\n', \
-                                              quoting=csv.QUOTE_ALL, \
-                                              quotechar='"')
-            text += '\r\n'
+        for idx in self.datatypes:
+            text += self.__block_csv(idx)
         return text
 
+    def __block_csv(self, idx):
+        '''
+            Reconstruct the csv of the data block of one datatype
+        '''
+        text = '\"DataType:\",\"{}\"\r\n'.format(idx)
+        text += self.__data.loc[idx].to_csv(line_terminator='\r\n', \
+                                          quoting=csv.QUOTE_ALL, \
+                                          quotechar='"')
+        text += '\r\n'
+        return text
+
+    def __source_snapshot(self, filename):
+        '''
+            Record where the header and every data block sit in the
+            source file (byte ranges) together with its meta data and
+            row labels, so that output() can copy unmodified ones
+        '''
+        starts = self.__datatypes.sort_values()
+        ends = starts.tolist()[1:] + [len(self.__offsets) - 1]
+        ranges = {'header': (0, self.__offsets[starts.iloc[0]])}
+        for (idx, start), end in zip(starts.items(), ends):
+            ranges[idx] = (self.__offsets[start], self.__offsets[end])
+        stat = os.stat(filename)
+        return {'filename': os.path.abspath(filename),
+                'stat': (stat.st_size, stat.st_mtime),
+                'ranges': ranges,
+                'meta': dict(self.__meta),
+                'sample_num': self.__sample_num,
+                'labels': self.__data.index,
+                'columns': self.__data.columns,
+                #sections changed outside the edit log e.g. by refresh()
+                'changed': set()}
+
+    def __modified_sections(self):
+        '''
+            Return the sections ('header' and datatypes) that may differ
+            from the source file, taken from the edit log so changes
+            reverted by undo() leave a section unmodified again
+        '''
+        sections = {'header'} | set(self.datatypes)
+        source = self.__source
+        if source is None or self.__sample_num != source['sample_num']:
+            return sections
+        try:
+            stat = os.stat(source['filename'])
+        except OSError:
+            return sections
+        if (stat.st_size, stat.st_mtime) != source['stat']:
+            return sections
+        #relabelled rows or columns, the same objects unless replaced
+        data = self.__data
+        if not (data.index is source['labels'] or
+                data.index.equals(source['labels'])) or \
+           not (data.columns is source['columns'] or
+                data.columns.equals(source['columns'])):
+            return sections
+
+        modified = set(source['changed'])
+        if self.__meta != source['meta']:
+            modified.add('header')
+        deltas = [delta for operation in self.__log for delta in operation]
+        deltas += self.__transaction or []
+        for delta in deltas:
+            if delta[0] == 'cells':
+                modified.update(data.index.get_level_values(0)[delta[1]])
+        return modified
+
+    def __write_sections(self, handle):
+        '''
+            Write the csv to an open binary file, copying clean
+            sections from the source file and rebuilding modified ones
+        '''
+        sections = [('header', self.__metacsv)] + \
+                   [(idx, lambda idx=idx: self.__block_csv(idx))
+                    for idx in self.datatypes]
+        modified = self.__modified_sections()
+        clean = [name for name, _ in sections if name not in modified]
+        source = open(self.__source['filename'], 'rb') if clean else None
+        try:
+            for name, rebuild in sections:
+                if name in clean:
+                    start, end = self.__source['ranges'][name]
+                    self.__copy_range(source, handle, start, end)
+                else:
+                    handle.write(rebuild().encode(ENCODING))
+        finally:
+            if source:
+                source.close()
+
+    @staticmethod
+    def __copy_range(source, target, start, end):
+        '''
+            Copy bytes [start, end) of the source file to the target
+        '''
+        target.flush()
+        count = end - start
+        try:
+            while count > 0:
+                sent = os.sendfile(target.fileno(), source.fileno(),
+                                   start, count)
+                if sent == 0:
+                    break
+                start += sent
+                count -= sent
+        except (AttributeError, OSError):
+            #no sendfile on this platform/file system
+            pass
+        if count > 0:
+            source.seek(start)
+            target.write(source.read(count))
+
 
     def __mod_loc(self, loc, delta):
         '''
@@ -351,6 +598,166 @@ class Luminosity:
             new_index.append((idx[0], self.__mod_loc(idx[1], delta)))
         return pd.MultiIndex.from_tuples(new_index, names=dframe.index.names)
 
+    def __lookup(self):
+        '''
+            Return the lookup indexes of the current data, they are
+            rebuilt when the data, its index or columns have been
+            replaced e.g. by merge_with(), after update_from() and
+            after refresh() for edits made through the data property
+        '''
+        index = self.__index
+        if index is None or index['data'] is not self.__data \
+           or index['labels'] is not self.__data.index \
+           or index['columns'] is not self.__data.columns:
+            self.__index = self.__build_index()
+        return self.__index
+
+    def __build_index(self):
+        '''
+            Build hash indexes of the data:
+                rows    : (datatype, location) --> row position
+                blocks  : datatype --> row positions
+                wells   : well e.g. 'A12' --> locations
+                samples : sample name --> locations
+                beads   : bead label --> column position
+        '''
+        index = self.__data.index
+        samples = self.samples
+        locations = Series(samples.index, index=samples.index)
+        wells = locations.str.extract(WELL_PATTERN, expand=False) \
+                         .fillna(locations)
+        parts = locations.str.partition(' ')
+
+        def group(keys):
+            positions = locations.groupby(keys.values).indices
+            return {key: locations.values[pos].tolist()
+                    for key, pos in positions.items()}
+
+        return {'data': self.__data,
+                'labels': index,
+                'columns': self.__data.columns,
+                'rows': dict(zip(index, range(len(index)))),
+                'blocks': Series(range(len(index)))
+                          .groupby(index.get_level_values(0)).indices,
+                'wells': group(wells),
+                'samples': group(samples),
+                'beads': {bead: self.__data.columns.get_loc(bead)
+                          for bead in self.beads},
+                'loc_dict': dict(zip(parts[2], parts[0]))}
+
+    def __lookup_rows(self, locations, datatype=None):
+        '''
+            Return the rows of the given locations for one, a list of
+            or all (None) datatypes using the lookup indexes
+        '''
+        rows = self.__lookup()['rows']
+        if datatype is None:
+            datatype = self.datatypes
+        elif isinstance(datatype, str):
+            datatype = [datatype]
+        pos = [rows[(dt, loc)] for dt in datatype for loc in locations
+               if (dt, loc) in rows]
+        return self.__data.iloc[pos]
+
+    @staticmethod
+    def __frame_diff(left, right, names, tolerance=0, text=()):
+        '''
+            Compare two aligned frames (same index and columns) as whole
+            arrays and return the cells that differ in a long dataframe
+            with the row labels (names), 'Column', 'Self' and 'Other'.
+            Numeric cells differ if apart by more than tolerance, other
+            cells and every cell of the text columns (e.g. 'Sample',
+            where '001' and '1' differ) if not equal as strings, two
+            blanks (NaN) are equal
+        '''
+        is_text = left.columns.isin(text)
+        lnum = left.apply(pd.to_numeric, errors='coerce').values
+        rnum = right.apply(pd.to_numeric, errors='coerce').values
+        lval = left.values
+        rval = right.values
+        lnull = pd.isnull(lval)
+        rnull = pd.isnull(rval)
+
+        numeric = ~np.isnan(lnum) & ~np.isnan(rnum) & ~is_text[None, :]
+        with np.errstate(invalid='ignore'):
+            changed = np.where(numeric,
+                               np.abs(lnum - rnum) > tolerance,
+                               (lval.astype(str) != rval.astype(str))
+                               & ~(lnull & rnull))
+
+        rows, cols = np.nonzero(changed)
+        cells = left.index[rows].to_frame(index=False)
+        cells.columns = names
+        cells['Column'] = left.columns[cols]
+        cells['Self'] = lval[rows, cols]
+        cells['Other'] = rval[rows, cols]
+        return cells
+
+    def __record(self, *deltas):
+        '''
+            Add changes as one operation to the edit log, or to the
+            open transaction
+        '''
+        if self.__transaction is not None:
+            self.__transaction.extend(deltas)
+        else:
+            self.__log.append(list(deltas))
+
+    def __meta_changed(self, changes):
+        '''
+            Callback of the meta dict: log the values being replaced
+        '''
+        self.__record(*[('meta', key, old, existed)
+                        for key, old, existed in changes])
+
+    def __set_rows(self, positions, new):
+        '''
+            Overwrite the data rows at the given positions with the
+            values of the new rows (NaN leaves a cell unchanged, same as
+            DataFrame.update) and log the replaced cells column by column
+        '''
+        positions = np.asarray(positions)
+        new = new.reindex(columns=self.__data.columns)
+        old_cells = {}
+        for col in range(len(self.__data.columns)):
+            before = self.__data.iloc[positions, col].values
+            after = new.iloc[:, col].values
+            changed = ~pd.isnull(after) & (before != after)
+            if changed.any():
+                old_cells[col] = before.copy()
+                self.__data.iloc[positions, col] = np.where(changed, after, before)
+        if old_cells:
+            self.__record(('cells', positions, old_cells))
+            #sample names may have changed
+            self.__index = None
+
+    def __revert(self, delta):
+        '''
+            Undo one logged change
+        '''
+        kind = delta[0]
+        if kind == 'cells':
+            _, positions, old_cells = delta
+            for col, before in old_cells.items():
+                self.__data.iloc[positions, col] = before
+            self.__index = None
+        elif kind == 'merge':
+            _, rows, sample_num, from_ref, from_index = delta
+            from_obj = from_ref() if from_ref is not None else None
+            self.__data = self.__data.iloc[:rows]
+            self.__sample_num = sample_num
+            #give the merged object its own location labels back
+            if from_obj is not None and \
+               len(from_index) == len(from_obj.data.index):
+                from_obj.data.index = from_index
+                from_obj.__index = None
+        elif kind == 'meta':
+            _, key, old, existed = delta
+            if existed:
+                dict.__setitem__(self.__meta, key, old)
+            else:
+                dict.pop(self.__meta, key, None)
+
     ########################### PROPERTIES ###########################
 
     @property
@@ -397,6 +804,14 @@ class Luminosity:
         return self.__meta
 
 
+    @property
+    def history(self):
+        '''
+            Return the kinds of changes in the edit log, one list per
+            operation that undo() can revert e.g. [['cells'], ['merge']]
+        '''
+        return [[delta[0] for delta in operation] for operation in self.__log]
+
     @property
     def cal_info(self):
         '''
@@ -419,7 +834,7 @@ class Luminosity:
             TO DO: this does not work with locations not in this format
                    make something fit other formats
         '''
-        return {x.split(' ')[1]:x.split(' ')[0] for x in self.samples.index}
+        return dict(self.__lookup()['loc_dict'])
 
 
     ######################### METHODS ###################################
@@ -439,6 +854,58 @@ class Luminosity:
         else:
             return ''
 
+    def get_well(self, well, datatype=None):
+        '''
+            Return the rows of a well position (e.g. 'A12') or location
+            label (e.g. '5 (A12)') for one, a list of or all datatypes,
+            merged data may hold more than one row per well
+            Example:
+            --------
+            get_well('A12', datatype='Median')
+        '''
+        locations = self.__lookup()['wells'].get(well, [well])
+        return self.__lookup_rows(locations, datatype)
+
+    def get_sample(self, name, datatype=None):
+        '''
+            Return all rows of a sample name for one, a list of or
+            all datatypes, repeated sample names give several rows
+            Example:
+            --------
+            get_sample('SAMPLE_008')
+        '''
+        locations = self.__lookup()['samples'].get(name, [])
+        return self.__lookup_rows(locations, datatype)
+
+    def get_bead(self, bead, datatype=None):
+        '''
+            Return the readings of one bead label for one or
+            all datatypes as a Series
+            Example:
+            --------
+            get_bead('12', datatype='Median')
+        '''
+        index = self.__lookup()
+        column = self.__data.iloc[:, index['beads'][bead]]
+        if datatype is None:
+            return column
+        return column.iloc[index['blocks'][datatype]]
+
+    def refresh(self):
+        '''
+            Tell the object its data was edited in place through the
+            data property, the lookup indexes are rebuilt and output()
+            rebuilds every data block
+            Example:
+            --------
+            csvobj1.data.loc[('Median', '1 (A1)'), '12'] = 0
+            csvobj1.refresh()
+        '''
+        self.__index = None
+        if self.__source is not None:
+            self.__source['changed'].update(self.datatypes)
+        return True
+
     def __update_loc(self, source, excluded:list=[]):
         excluded = [x.replace('(','').replace(')', '') for x in excluded]
         source_locs = source.loc_dict
@@ -446,7 +913,9 @@ class Luminosity:
         s_locs = []
         t_locs = []
         for k, v in source_locs.items():
-            if k.replace('(','').replace(')','') not in excluded:
+            #wells not used on the target plate are left out
+            if k.replace('(','').replace(')','') not in excluded \
+               and k in target_locs:
                 s_locs.append(f'{v} {k}')
                 t_locs.append(f'{target_locs[k]} {k}')
         return s_locs, t_locs
@@ -482,30 +951,18 @@ class Luminosity:
 
                 sdata = from_obj.data
 
-                #back up data before updating
-                backup_data = self.__data.copy()
-
-                #updating...
+                #pair up source and target rows of every datatype
+                target_rows = self.__lookup()['rows']
+                source_rows = from_obj.__lookup()['rows']
+                tpos = []
+                spos = []
                 for floc, tloc in zip(from_loc, to_loc):
-                    temp = sdata.xs(floc, level=1,
-                                    drop_level=False)
+                    for idx in self.datatypes:
+                        tpos.append(target_rows[(idx, tloc)])
+                        spos.append(source_rows[(idx, floc)])
 
-                    #set the source location index same as target for update
-                    locations = temp.index.levels[1].values
-                    pos = list(locations).index(floc)
-                    locations[pos] = tloc
-
-                    #update the backup of this dataframe from source
-                    backup_data.update(temp)
-
-                    #reverse the source location index back to previous value
-                    #NB: when the index of a new copy of a dataframe changes
-                    #the original corresponding index in the old dataframe
-                    #also changes.
-                    locations[pos] = floc
-
-                #if no exception, update the data of this object
-                self.__data = backup_data
+                #updating... only the replaced cells are kept for undo()
+                self.__set_rows(tpos, sdata.iloc[spos])
                 return True
 
             else:
@@ -513,17 +970,110 @@ class Luminosity:
         except ValueError:
             msg = ('Update Failed: <{}> do not have identical bead '
                    'labels and/or data types to this object!'
-                   .format(from_obj.FileName))
+                   .format(from_obj.file_name))
 
             return False, msg
 
 
 
+    def to_long(self, datatypes=None, chunksize=100000):
+        '''
+            Generate the data as tidy (long) dataframes of at most
+            chunksize rows, one block at a time, with 'Session',
+            'DataType', 'Location', 'Sample', 'Bead' and 'Value' columns
+            values are numbers, ints for the Count datatypes
+            datatypes = list of datatypes to include, None for all
+            Example:
+            --------
+            for chunk in csvobj.to_long(chunksize=50000):
+                chunk.to_sql('bead_values', con, if_exists='append')
+        '''
+        session = self.__meta['Session']
+        beads = self.beads
+        step = max(1, chunksize // max(1, len(beads)))
+        for idx in datatypes or self.datatypes:
+            block = self.__data.loc[idx]
+            for start in range(0, len(block), step):
+                part = block.iloc[start:start + step]
+                #same conversion as the csv parser and iter_csv_records
+                values = pd.to_numeric(Series(part[beads].values.ravel()),
+                                       errors='coerce')
+                if 'Count' in idx:
+                    values = values.astype('Int64').astype(object)
+                    values = values.where(values.notnull(), None)
+                yield DataFrame({
+                    'Session': session,
+                    'DataType': idx,
+                    'Location': np.repeat(part.index.values, len(beads)),
+                    'Sample': np.repeat(part['Sample'].values, len(beads)),
+                    'Bead': np.tile(beads, len(part)),
+                    'Value': values.values})
+
+    def iter_records(self, datatypes=None, chunksize=100000):
+        '''
+            Generate tidy records as tuples of
+            (session, datatype, location, sample, bead, value)
+            see iter_csv_records() to stream straight from a csv file,
+            missing values are None in both
+        '''
+        for chunk in self.to_long(datatypes, chunksize):
+            value = chunk['Value'].astype(object)
+            chunk['Value'] = value.where(value.notnull(), None)
+            yield from chunk.itertuples(index=False, name=None)
+
+    def diff(self, other, tolerance=0):
+        '''
+            Compare this object with another Luminosity object or csv file
+            aligned on DataType, Location and bead (column) labels.
+            tolerance = largest absolute difference of numeric values
+                        still treated as unchanged
+            Returns a dict:
+                data         : changed cells in a long dataframe with
+                               'DataType', 'Location', 'Column', 'Self'
+                               and 'Other' columns
+                rows_added   : (DataType, Location) only in other
+                rows_removed : (DataType, Location) only in this object
+                columns_added / columns_removed : same for columns
+                meta         : {name: (this value, other value)}
+                cal / con    : changed CAL/CON cells, same as data
+            Example:
+            --------
+            changes = csvobj1.diff('repeat.csv', tolerance=0.5)
+            changes['data'].groupby('DataType').size()
+        '''
+        if not isinstance(other, Luminosity):
+            other = Luminosity(other)
+
+        changes = {}
+        for name, left, right, names in [
+                ('data', self.__data, other.data, ['DataType', 'Location']),
+                ('cal', self.cal_info, other.cal_info, ['ProductName']),
+                ('con', self.con_info, other.con_info, ['ProductName'])]:
+            #sample names and the blank closing column are not numbers
+            text = ['Sample', ''] if name == 'data' else []
+            #only compare the rows and columns found in both
+            rows = left.index.intersection(right.index)
+            cols = left.columns.intersection(right.columns)
+            changes[name] = self.__frame_diff(left.loc[rows, cols],
+                                              right.loc[rows, cols],
+                                              names, tolerance, text)
+            if name == 'data':
+                changes['rows_added'] = right.index.difference(rows).tolist()
+                changes['rows_removed'] = left.index.difference(rows).tolist()
+                changes['columns_added'] = right.columns.difference(cols).tolist()
+                changes['columns_removed'] = left.columns.difference(cols).tolist()
+
+        changes['meta'] = {key: (self.__meta.get(key), other.meta.get(key))
+                           for key in set(self.__meta) | set(other.meta)
+                           if self.__meta.get(key) != other.meta.get(key)}
+        return changes
+
     def merge_with(self, from_obj, updateloc=True, ignorecheck=False):
         '''
             Merge/concatenate data from another csv file
             updateloc = True:
-                Modify the 'Location' index of from_obj
+                Modify the 'Location' index of from_obj, undo()
+                gives from_obj (if still alive) its original labels back
             updateloc = False:
                 Leave the 'Location' indices unchanged
 
@@ -541,29 +1091,161 @@ class Luminosity:
 
         totalnum = self.sample_num + from_obj.sample_num
 
+        #only the original labels and a weak reference are logged
+        from_ref = from_index = None
         if updateloc:
+            from_ref = weakref.ref(from_obj)
+            from_index = from_obj.data.index
             from_obj.data.index = self.__mod_index(from_obj.data, \
 								  delta=self.sample_num)
+            from_obj.__index = None
+        self.__record(('merge', len(self.__data), self.__sample_num,
+                       from_ref, from_index))
         self.__sample_num = totalnum
         self.__data = pd.concat([self.__data, from_obj.data])
 
 
+    def undo(self):
+        '''
+            Revert the last update_from(), merge_with(), meta edit or
+            transaction, returns False when there is nothing to undo
+        '''
+        if self.__transaction is not None:
+            raise RuntimeError('undo() is not allowed inside a transaction, '
+                               'use rollback()')
+        if not self.__log:
+            return False
+        for delta in reversed(self.__log.pop()):
+            self.__revert(delta)
+        return True
+
+    def commit(self, keep=0):
+        '''
+            Discard the edit log keeping the changes, except the last
+            keep operations, to free the memory it holds
+            returns the number of operations discarded
+            Example:
+            --------
+            csvobj1.commit()        # nothing left to undo
+            csvobj1.commit(keep=5)  # the last 5 steps can be undone
+        '''
+        if self.__transaction is not None:
+            raise RuntimeError('commit() is not allowed inside a transaction')
+        keep = max(0, keep)
+        dropped = self.__log[:len(self.__log) - keep]
+        self.__log = self.__log[len(self.__log) - keep:]
+        if self.__source is not None:
+            #committed cell changes still differ from the source file
+            for delta in (d for operation in dropped for d in operation):
+                if delta[0] == 'cells':
+                    self.__source['changed'].update(
+                        self.__data.index.get_level_values(0)[delta[1]])
+        return len(dropped)
+
+    def rollback(self):
+        '''
+            Revert every change of the open transaction, or outside a
+            transaction every logged change back to the loaded state
+            returns the number of changes reverted
+        '''
+        if self.__transaction is not None:
+            deltas = self.__transaction
+            self.__transaction = []
+        else:
+            deltas = [delta for operation in self.__log for delta in operation]
+            self.__log = []
+        for delta in reversed(deltas):
+            self.__revert(delta)
+        return len(deltas)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+            Group several changes into one undo() step, all of them are
+            reverted if an exception is raised inside the block
+            Example:
+            --------
+            with csvobj1.transaction():
+                csvobj1.update_from(csvobj2, '1 (C2)', '1 (E11)')
+                csvobj1.meta['Operator'] = 'New Operator'
+        '''
+        if self.__transaction is not None:
+            #nested transactions join the outer one
+            yield self
+            return
+        self.__transaction = []
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            self.__transaction = None
+            raise
+        deltas = self.__transaction
+        self.__transaction = None
+        if deltas:
+            self.__log.append(deltas)
+
     def output(self, filename=None):
         '''
             Outputs(writes) the data as a fully and correctly formatted
             Luminex csv file to a given file name. if no name is given
             write to the current folder using the current filename_new.csv
             as output destination file name.
+            Sections (header, each DataType block) not modified since
+            the source file was read are copied from it byte for byte,
+            only modified ones are rebuilt. Call refresh() after
+            editing the data property in place.
             returns true/false and the output path depending on success
         '''
         if filename:
             file = filename
         else:
             file = self.file_name.replace('.csv', '_new.csv')
-        text = self.__metacsv() + self.__data_csv()
+        #write next to the target first, the source may be overwritten
+        temp = file + '.tmp'
         try:
-            with open(file, 'w', newline='') as handle:
-                handle.write(text)
+            with open(temp, 'wb') as handle:
+                self.__write_sections(handle)
+            os.replace(temp, file)
             return True, file
         except Exception:
+            if os.path.exists(temp):
+                os.remove(temp)
             return False, file
+
+
+def iter_csv_records(filename):
+    '''
+        Generate tidy records as tuples of
+        (session, datatype, location, sample, bead, value)
+        straight from a Luminex csv file one line at a time, without
+        building a Luminosity object, for loading very large files
+        Example:
+        --------
+        cursor.executemany(insert_sql, iter_csv_records(path_to_csv))
+    '''
+    session = ''
+    datatype = None
+    beads = None
+    with open(filename, 'r', newline='') as handle:
+        for row in csv.reader(handle):
+            if not row or not any(row):
+                #a blank line closes a data block
+                datatype = beads = None
+            elif 'DataType:' in row[0]:
+                datatype = row[1]
+                dtype = int if 'Count' in datatype else float
+            elif datatype is None:
+                if row[0] == 'Session' and len(row) > 1:
+                    session = row[1]
+            elif beads is None:
+                #same bead columns as Luminosity.beads
+                beads = row[2:-2]
+            else:
+                location, sample = row[0], row[1]
+                for bead, value in zip(beads, row[2:2 + len(beads)]):
+                    try:
+                        value = dtype(value)
+                    except ValueError:
+                        value = None
+                    yield (session, datatype, location, sample, bead, value)
@@ -0,0 +1,116 @@
+'''
+Local MFI normalization of Luminosity data with control beads
+'''
+import numpy as np
+import pandas as pd
+from pandas import Series, DataFrame
+from luminosity import Luminosity
+
+#S = sample MFI, BG = lot background (negative control serum) MFI
+#N = a bead, NC / PC = negative / positive control bead
+METHODS = {
+    #S#N - S#NC
+    'background': lambda s, nc, pc, bg, bg_nc: s - nc,
+    #(S#N - S#NC) - (BG#N - BG#NC), OneLambda normalized (baseline) value
+    'baseline': lambda s, nc, pc, bg, bg_nc: (s - nc) - (bg - bg_nc),
+    #(S#N / S#NC) / (BG#N / BG#NC)
+    'ratio': lambda s, nc, pc, bg, bg_nc: (s / nc) / (bg / bg_nc),
+    #(S#N - S#NC) / (S#PC - S#NC) x 100, percentage of positive control
+    'pc': lambda s, nc, pc, bg, bg_nc: (s - nc) / (pc - nc) * 100,
+}
+
+
+def data_block(runs, datatype='Median'):
+    '''
+        Return the data block of one datatype from a Luminosity object,
+        its data frame or a list of Luminosity objects (a batch of
+        plates, keyed by file name in the first index level)
+    '''
+    if isinstance(runs, Luminosity):
+        return runs.data.loc[datatype]
+    if isinstance(runs, DataFrame):
+        return runs.loc[datatype]
+    return pd.concat([run.data.loc[datatype] for run in runs],
+                     keys=[run.file_name for run in runs], sort=False)
+
+
+def bead_labels(runs):
+    '''
+        Return the bead labels of a Luminosity object, its data frame
+        or a list of Luminosity objects, in order of first appearance
+    '''
+    if isinstance(runs, Luminosity):
+        return runs.beads
+    if isinstance(runs, DataFrame):
+        #same bead columns as Luminosity.beads
+        return runs.columns[1:-2].tolist()
+    return pd.unique(np.concatenate([run.beads for run in runs])).tolist()
+
+
+def normalize(runs, nc_bead, pc_bead=None, background=None,
+              datatype='Median', method='baseline'):
+    '''
+        Compute normalized MFI of every well and bead in one go
+        runs       : Luminosity object, its data or a list of objects
+        nc_bead    : label of the negative control bead
+        pc_bead    : label of the positive control bead ('pc' method)
+        background : per lot constants, bead label -> background MFI
+                     including the NC bead ('baseline', 'ratio' methods)
+        method     : one of METHODS
+        Returns a dataframe with the same rows as the data block,
+        'Sample' and one column of normalized values per bead
+        Example:
+        --------
+        normalize(c, nc_bead='1', background=lot_bg)
+        normalize([c1, c2, c3], nc_bead='1', pc_bead='2', method='pc')
+    '''
+    if method not in METHODS:
+        raise ValueError(f'Unknown method: {method}, use one of {list(METHODS)}')
+    if method == 'pc' and pc_bead is None:
+        raise ValueError('The pc method needs the positive control bead')
+
+    block = data_block(runs, datatype)
+    #plates of a batch may not share every bead, missing ones are NaN
+    beads = bead_labels(runs)
+    values = block[beads].apply(pd.to_numeric, errors='coerce').values
+
+    #controls as columns so they broadcast over every bead of a well
+    nc = values[:, beads.index(str(nc_bead))][:, None]
+    pc = values[:, beads.index(str(pc_bead))][:, None] \
+         if pc_bead is not None else np.nan
+
+    if background is not None:
+        background = Series(background, dtype=float)
+        background.index = background.index.astype(str)
+        bg = background.reindex(beads).values[None, :]
+        bg_nc = background[str(nc_bead)]
+    elif method in ('baseline', 'ratio'):
+        raise ValueError(f'The {method} method needs the lot background values')
+    else:
+        bg = bg_nc = np.nan
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = METHODS[method](values, nc, pc, bg, bg_nc)
+
+    normalized = DataFrame(result, index=block.index, columns=beads)
+    normalized.insert(0, 'Sample', block['Sample'])
+    return normalized
+
+
+def compare_with_fusion(normalized, fusion_results, value='baseline_value'):
+    '''
+        Compare normalized values with the values stored by fusion
+        (e.g. from read_data_from_fusion) matching sample names and
+        bead ids, returns 'Sample', 'Bead', 'Local', 'Fusion' and
+        'Difference' columns
+    '''
+    local = normalized.set_index('Sample').stack().rename('Local')
+    local.index.names = ['Sample', 'Bead']
+
+    fusion = fusion_results.assign(Bead=fusion_results['bead_id'].astype(str))
+    fusion = fusion.groupby(['sample_name', 'Bead'])[value].last()
+    fusion.index.names = ['Sample', 'Bead']
+
+    both = local.to_frame().join(fusion.rename('Fusion'), how='inner')
+    both['Difference'] = both['Local'] - both['Fusion']
+    return both.reset_index()
@@ -0,0 +1,180 @@
+'''
+Reconcile repeat plates with primary runs by sample name
+'''
+import pandas as pd
+from pandas import DataFrame
+
+PLAN_COLUMNS = ['Target', 'TargetLocation', 'Sample', 'Source',
+                'SourceLocation', 'Date', 'MinCount']
+
+
+class Reconciler:
+    '''
+    Patch primary runs with the best reading of each sample found on
+    a batch of repeat plates, matching wells by sample name
+    Reconciler.candidates: property, every repeat well with its rule values
+    Reconciler.plan(): function, the transfers the rules pick
+    Reconciler.apply(): function, carry out the transfers
+
+    min_count = a repeat well is good if every bead has at least this
+                many events in the count datatype, None accepts all
+    prefer = 'latest': the good well of the latest repeat run wins
+             'count': the good well with the highest bead count wins
+    exclude = sample names never transferred e.g. controls run on
+              every plate
+    Example:
+    --------
+    rec = Reconciler([run1, run2], [repeat1, repeat2, repeat3], min_count=50)
+    rec.plan()    # check what will be moved
+    rec.apply()   # patch run1 and run2
+    '''
+    def __init__(self, targets, repeats, min_count=None, prefer='latest',
+                 exclude=(), count_datatype='Count'):
+        if prefer not in ('latest', 'count'):
+            raise ValueError(f'Unknown rule: {prefer}, use latest or count')
+        self.targets = list(targets)
+        self.repeats = list(repeats)
+        self.min_count = min_count
+        self.prefer = prefer
+        self.exclude = set(exclude)
+        self.count_datatype = count_datatype
+
+    def __wells(self, run):
+        '''
+        helper function: location, sample name and lowest bead count
+        of every well of a run
+        '''
+        samples = run.samples
+        wells = DataFrame({'Location': samples.index,
+                           'Sample': samples.values})
+        if self.count_datatype in run.datatypes:
+            counts = run.data.loc[self.count_datatype][run.beads] \
+                        .apply(pd.to_numeric, errors='coerce')
+            wells['MinCount'] = counts.min(axis=1).values
+        else:
+            wells['MinCount'] = float('nan')
+        return wells[wells['Sample'].notnull() & (wells['Sample'] != '')
+                     & ~wells['Sample'].isin(self.exclude)]
+
+    @property
+    def candidates(self):
+        '''
+        return every well of the repeat runs (the sample name index)
+        with run position, run date and lowest bead count
+        '''
+        frames = []
+        for pos, run in enumerate(self.repeats):
+            wells = self.__wells(run)
+            wells['Run'] = pos
+            wells['Date'] = pd.to_datetime(run.meta['Date'], errors='coerce')
+            frames.append(wells)
+        if not frames:
+            return DataFrame(columns=['Location', 'Sample', 'MinCount',
+                                      'Run', 'Date'])
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def __compatible(target, repeat, ignorecheck=False):
+        '''
+        helper function: True if update_from() accepts the wells of
+        the repeat run for the target run
+        '''
+        return target.beads == repeat.beads and \
+               target.datatypes == repeat.datatypes and \
+               (ignorecheck or
+                target.meta['TemplateName'] == repeat.meta['TemplateName'])
+
+    def __winners(self, candidates):
+        '''
+        helper function: the winning repeat well of every sample
+        '''
+        if self.min_count is not None:
+            candidates = candidates[candidates['MinCount'] >= self.min_count]
+        if self.prefer == 'latest':
+            #later runs in the list win runs of the same date
+            order = ['Date', 'Run', 'MinCount']
+        else:
+            order = ['MinCount', 'Date', 'Run']
+        candidates = candidates.sort_values(order, ascending=False,
+                                            na_position='last')
+        return candidates.drop_duplicates('Sample', keep='first')
+
+    def __transfers(self, ignorecheck=False):
+        '''
+        helper function: target wells paired with the winning wells
+        of the repeat runs compatible with each target, so a
+        mismatched plate never blocks the next best good well
+        '''
+        candidates = self.candidates
+        winners = {}
+        frames = []
+        for pos, run in enumerate(self.targets):
+            usable = tuple(repeat_pos for repeat_pos, repeat
+                           in enumerate(self.repeats)
+                           if self.__compatible(run, repeat, ignorecheck))
+            #targets of the same kind share their winners
+            if usable not in winners:
+                winners[usable] = self.__winners(
+                    candidates[candidates['Run'].isin(usable)])
+            samples = run.samples
+            wells = DataFrame({'TargetRun': pos,
+                               'TargetLocation': samples.index,
+                               'Sample': samples.values})
+            frames.append(wells.merge(winners[usable], on='Sample'))
+        if not frames:
+            return DataFrame(columns=['TargetRun', 'TargetLocation', 'Sample',
+                                      'Location', 'MinCount', 'Run', 'Date'])
+        return pd.concat(frames, ignore_index=True)
+
+    def plan(self, transfers=None, ignorecheck=False):
+        '''
+        return the transfers as 'Target', 'TargetLocation', 'Sample',
+        'Source', 'SourceLocation', 'Date' and 'MinCount' columns,
+        target and source are file names, repeat runs with other
+        beads, datatypes or template (unless ignorecheck) than a
+        target are not used for it
+        '''
+        if transfers is None:
+            transfers = self.__transfers(ignorecheck)
+        plan = DataFrame({
+            'Target': [self.targets[pos].file_name for pos in transfers['TargetRun']],
+            'TargetLocation': transfers['TargetLocation'],
+            'Sample': transfers['Sample'],
+            'Source': [self.repeats[pos].file_name for pos in transfers['Run']],
+            'SourceLocation': transfers['Location'],
+            'Date': transfers['Date'],
+            'MinCount': transfers['MinCount']})
+        return plan[PLAN_COLUMNS]
+
+    def apply(self, ignorecheck=False):
+        '''
+        carry out all transfers, one transaction per target run so a
+        target is either fully patched or left unchanged (and can be
+        reverted with one undo() call)
+        returns the plan with an 'Applied' column and an 'Error'
+        column holding why a target was left unchanged
+        '''
+        transfers = self.__transfers(ignorecheck)
+        applied = pd.Series(False, index=transfers.index)
+        errors = pd.Series('', index=transfers.index)
+        for target_pos, by_target in transfers.groupby('TargetRun'):
+            target = self.targets[target_pos]
+            try:
+                with target.transaction():
+                    for source_pos, moves in by_target.groupby('Run'):
+                        result = target.update_from(
+                            self.repeats[source_pos],
+                            moves['Location'].tolist(),
+                            moves['TargetLocation'].tolist(),
+                            ignorecheck=ignorecheck)
+                        if result is not True:
+                            raise ValueError(result[1])
+            except (ValueError, AssertionError, KeyError) as e:
+                errors[by_target.index] = f'{e.__class__.__name__}: {e}'
+                continue
+            applied[by_target.index] = True
+
+        plan = self.plan(transfers)
+        plan['Applied'] = applied.values
+        plan['Error'] = errors.values
+        return plan
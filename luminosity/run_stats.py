@@ -0,0 +1,164 @@
+'''
+Incremental statistics of bead and CAL/CON readings across runs
+'''
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+STATE_COLUMNS = ['Run', 'Date', 'Source', 'Key', 'n', 'mean', 'm2']
+
+
+def combine(summaries, by):
+    '''
+        Combine count/mean/m2 (sum of squared deviations) summaries of
+        separate groups of readings into one per key (Chan et al.)
+    '''
+    weighted = summaries.assign(total=summaries['n'] * summaries['mean'])
+    grouped = weighted.groupby(by)
+    n = grouped['n'].sum()
+    mean = grouped['total'].sum() / n
+    spread = weighted['n'] * (weighted['mean']
+                              - mean.reindex(pd.MultiIndex.from_frame(weighted[by]))
+                                    .values) ** 2
+    m2 = grouped['m2'].sum() + spread.groupby([weighted[col] for col in by]).sum()
+    #per-run summaries count one run per row
+    runs = grouped['runs'].sum() if 'runs' in summaries else grouped.size()
+    return DataFrame({'n': n, 'mean': mean, 'm2': m2, 'runs': runs})
+
+
+class RunStatistics:
+    '''
+    Rolling mean, SD and CV of bead readings of one datatype and of
+    the CAL/CON readings, updated one Luminosity run at a time
+    RunStatistics.runs: property, ids of the runs added so far
+    RunStatistics.add(): function, add the readings of one run
+    RunStatistics.stats(): function, statistics of all runs or a date window
+    RunStatistics.save(): function, write the state to a csv file
+    RunStatistics.load(): classmethod, read a saved state back
+
+    Each run is kept as one count/mean/m2 summary per bead and control
+    reading, so adding a run never re-reads earlier ones.
+    '''
+    def __init__(self, datatype='Median'):
+        self.datatype = datatype
+        self.__summaries = []
+        self.__state = None
+        self.__totals = None
+        self.__run_ids = set()
+
+    @property
+    def runs(self):
+        return sorted(self.__run_ids)
+
+    def __summaries_frame(self):
+        '''
+        helper function: all per-run summaries in one dataframe
+        '''
+        if self.__summaries:
+            frames = [self.__state] if self.__state is not None else []
+            self.__state = pd.concat(frames + self.__summaries,
+                                     ignore_index=True)
+            self.__summaries = []
+        if self.__state is None:
+            return DataFrame(columns=STATE_COLUMNS)
+        return self.__state
+
+    def __summarize(self, run):
+        '''
+        helper function: count/mean/m2 of every bead over the wells of
+        a run, and each CAL/CON reading as a single observation
+        '''
+        block = run.data.loc[self.datatype][run.beads] \
+                   .apply(pd.to_numeric, errors='coerce')
+        mean = block.mean()
+        beads = DataFrame({'Source': self.datatype,
+                           'Key': block.columns,
+                           'n': block.count().values,
+                           'mean': mean.values,
+                           'm2': ((block - mean) ** 2).sum().values})
+
+        controls = []
+        for source, info in (('CAL', run.cal_info), ('CON', run.con_info)):
+            if info.empty:
+                continue
+            readings = info.stack()
+            controls.append(DataFrame({
+                'Source': source,
+                'Key': [f'{product} {column}' for product, column in readings.index],
+                'n': 1,
+                'mean': readings.values,
+                'm2': 0.0}))
+        return pd.concat([beads] + controls, ignore_index=True)
+
+    def add(self, run, run_id=None):
+        '''
+        add the readings of a Luminosity object, dated by meta['Date']
+        a run_id (default the file name) already added is skipped
+        returns True if the run was added
+        '''
+        run_id = run_id or run.file_name
+        if run_id in self.__run_ids:
+            return False
+        self.__run_ids.add(run_id)
+
+        summary = self.__summarize(run)
+        summary.insert(0, 'Run', run_id)
+        summary.insert(1, 'Date', pd.to_datetime(run.meta['Date'],
+                                                 errors='coerce'))
+        self.__summaries.append(summary[STATE_COLUMNS])
+
+        #update the running totals with this run only
+        new = summary.set_index(['Source', 'Key'])[['n', 'mean', 'm2']] \
+                     .assign(runs=1)
+        if self.__totals is None:
+            self.__totals = new
+        else:
+            both = pd.concat([self.__totals, new]).reset_index()
+            self.__totals = combine(both, ['Source', 'Key'])
+        return True
+
+    def stats(self, start=None, end=None):
+        '''
+        return n, mean, sd, cv (%) and the number of runs per source
+        (datatype, CAL or CON) and key (bead or control reading)
+        over all runs, or runs dated start <= date < end
+        '''
+        if start is None and end is None:
+            totals = self.__totals if self.__totals is not None \
+                     else DataFrame(columns=['n', 'mean', 'm2', 'runs'])
+        else:
+            state = self.__summaries_frame()
+            dates = pd.to_datetime(state['Date'])
+            window = np.ones(len(state), dtype=bool)
+            if start is not None:
+                window &= (dates >= pd.to_datetime(start)).values
+            if end is not None:
+                window &= (dates < pd.to_datetime(end)).values
+            totals = combine(state[window], ['Source', 'Key'])
+
+        result = totals[['n', 'mean']].copy()
+        result['sd'] = np.sqrt(totals['m2'] / (totals['n'] - 1))
+        result['cv'] = result['sd'] / result['mean'] * 100
+        result['runs'] = totals['runs']
+        return result
+
+    def save(self, filename):
+        '''
+        write the per-run summaries to a csv file
+        '''
+        self.__summaries_frame().to_csv(filename, index=False)
+        return True
+
+    @classmethod
+    def load(cls, filename, datatype='Median'):
+        '''
+        read a state written by save()
+        '''
+        obj = cls(datatype)
+        state = pd.read_csv(filename, parse_dates=['Date'],
+                            dtype={'Run': str, 'Key': str})
+        if not state.empty:
+            obj.__state = state[STATE_COLUMNS]
+            obj.__totals = combine(state, ['Source', 'Key'])
+            obj.__run_ids = set(state['Run'])
+        return obj
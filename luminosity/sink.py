@@ -0,0 +1,80 @@
+'''
+Module handling buffered export of data frames to a single file
+'''
+import os
+import sqlite3
+import pandas as pd
+
+class ExportSink:
+    '''
+    Append data frames into one csv file or sqlite table
+    ExportSink.write(): function, buffer a data frame for writing
+    ExportSink.flush(): function, write all buffered data frames
+    ExportSink.close(): function, flush and release the sink
+
+    kind = 'csv':
+        append rows to a csv file, the header is written once
+    kind = 'sqlite':
+        append rows to a table in a sqlite database file
+    batch_size = number of data frames buffered before a write
+    '''
+    def __init__(self, path, kind='csv', table='comparison', batch_size=100):
+        if kind not in ('csv', 'sqlite'):
+            raise ValueError(f'Unknown sink kind: {kind}')
+        self.path = path
+        self.kind = kind
+        self.table = table
+        self.batch_size = batch_size
+        self.rows_written = 0
+        self.__buffer = []
+        self.__connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, dframe, **columns):
+        '''
+        buffer a data frame, extra keyword arguments are added
+        as constant columns e.g. msession_id='S1', msample_id='P1'
+        '''
+        if columns:
+            dframe = dframe.assign(**columns)
+        self.__buffer.append(dframe)
+        if len(self.__buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        write all buffered data frames in one go
+        '''
+        if not self.__buffer:
+            return 0
+        batch = pd.concat(self.__buffer, ignore_index=True, sort=False)
+        self.__buffer = []
+
+        if self.kind == 'csv':
+            header = not os.path.exists(self.path) or \
+                     os.path.getsize(self.path) == 0
+            batch.to_csv(self.path, mode='a', header=header, index=False)
+        else:
+            if self.__connection is None:
+                self.__connection = sqlite3.connect(self.path)
+            batch.to_sql(self.table, self.__connection,
+                         if_exists='append', index=False)
+            self.__connection.commit()
+
+        self.rows_written += len(batch)
+        return len(batch)
+
+    def close(self):
+        '''
+        flush what is left in the buffer and close
+        '''
+        self.flush()
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+        return True
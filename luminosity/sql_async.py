@@ -0,0 +1,185 @@
+'''
+Asyncio access to the vendor databases
+'''
+import asyncio
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from vendor_query import (fusion_bead_sql, matchit_mfi_sql, fusion_mfi_sql,
+                          group_matchit, group_fusion)
+
+class AsyncSqlConnect:
+    '''
+    Run blocking DB-API queries on a pool of worker threads
+    AsyncSqlConnect.read_sql_query(): coroutine, run a query into a DataFrame
+    AsyncSqlConnect.close(): function, close the pool and its connections
+
+    connect = callable returning a new DB-API connection, it is called
+              once per worker thread e.g.
+              lambda: pypyodbc.connect(conf.connection_string)
+              lambda: sqlite3.connect(path, check_same_thread=False)
+    max_workers = maximum number of queries running at the same time
+    timeout = default seconds to wait for a query, None waits forever
+    '''
+    def __init__(self, connect, max_workers=4, timeout=None):
+        self.__connect = connect
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__semaphore = None
+        self.__local = threading.local()
+        self.__connections = []
+        self.__lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def __connection(self):
+        '''
+        helper function: the connection of the current worker thread
+        '''
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = self.__connect()
+            self.__local.connection = connection
+            with self.__lock:
+                self.__connections.append(connection)
+        return connection
+
+    def __query(self, sql, params, timeout, running):
+        '''
+        helper function: run a query in a worker thread, with a
+        statement timeout so the server aborts it when the driver
+        supports one (pypyodbc cursor.set_timeout)
+        '''
+        connection = self.__connection()
+        cursor = connection.cursor()
+        running.extend([connection, cursor])
+        if timeout and hasattr(cursor, 'set_timeout'):
+            cursor.set_timeout(max(1, math.ceil(timeout)))
+        try:
+            if params:
+                cursor.execute(sql, params)
+            else:
+                cursor.execute(sql)
+            if cursor.description is None:
+                return pd.DataFrame()
+            columns = [col[0] for col in cursor.description]
+            return pd.DataFrame.from_records(cursor.fetchall(), columns=columns)
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def __cancel(running):
+        '''
+        helper function: ask the driver to stop a running query
+        '''
+        if not running:
+            return
+        connection, cursor = running
+        for stop in (getattr(cursor, 'cancel', None),
+                     getattr(connection, 'interrupt', None)):
+            if stop is not None:
+                try:
+                    stop()
+                    return
+                except Exception:
+                    pass
+
+    @staticmethod
+    def __finished(future, semaphore):
+        '''
+        helper function: give the worker slot back when a query ends,
+        an abandoned query's error is read so it is not reported
+        '''
+        semaphore.release()
+        if not future.cancelled():
+            future.exception()
+
+    async def read_sql_query(self, sql, params=None, timeout=None):
+        '''
+        run a query on a worker thread and return a DataFrame
+        raises asyncio.TimeoutError when timeout (or the default
+        timeout) runs out, the query is then cancelled if the
+        driver supports it, its worker slot is only given back once
+        the query has really stopped so at most max_workers queries
+        ever run at the same time
+        '''
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_workers)
+        if timeout is None:
+            timeout = self.timeout
+
+        loop = asyncio.get_running_loop()
+        running = []
+        semaphore = self.__semaphore
+        await semaphore.acquire()
+        try:
+            future = loop.run_in_executor(self.__executor, self.__query,
+                                          sql, params, timeout, running)
+        except BaseException:
+            semaphore.release()
+            raise
+        future.add_done_callback(lambda done: self.__finished(done, semaphore))
+        try:
+            #shielded so a timeout does not mark the query finished
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            self.__cancel(running)
+            raise
+
+    def close(self):
+        '''
+        close the worker threads and all connections
+        '''
+        self.__executor.shutdown(wait=True)
+        with self.__lock:
+            for connection in self.__connections:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            self.__connections = []
+        return True
+
+
+async def read_data_from_fusion(patient_local_id, fusiondb,
+                                sql=fusion_bead_sql, **kwargs):
+    '''
+    extract bead values from fusion given a unique patient_local_id
+    fusiondb is an AsyncSqlConnect, other keyword arguments are the
+    same as fusion.read_data_from_fusion plus timeout
+    sql builds the statement from the same arguments, replace it to
+    run against another database e.g. a sqlite stand-in
+    '''
+    timeout = kwargs.pop('timeout', None)
+    return await fusiondb.read_sql_query(sql(patient_local_id, **kwargs),
+                                         timeout=timeout)
+
+
+async def read_matchitdata(session_id, sample_id, matchitdb, timeout=None,
+                           sql=matchit_mfi_sql):
+    '''
+        execute the store procedure in matchIT to extract
+        bead (antigen) and adjustn (AD-BG MFI) values
+        sql(session_id, sample_id) builds the statement
+    '''
+    md = await matchitdb.read_sql_query(sql(session_id, sample_id),
+                                        timeout=timeout)
+    return group_matchit(md)
+
+
+async def read_fusiondata(session_id, sample_id, fusiondb, timeout=None,
+                          sql=fusion_mfi_sql):
+    '''
+        execute the store procedure in fusion to extract
+        bead (antigen) and normalvalue (normalised MFI) values
+        sql(session_id, sample_id) builds the statement
+    '''
+    fd = await fusiondb.read_sql_query(sql(session_id, sample_id),
+                                       timeout=timeout)
+    return group_fusion(fd)
@@ -1,25 +1,115 @@
+import time
 import pypyodbc
+import pandas as pd
 from sql_config import Configuration
 
+#ODBC SQLSTATE codes worth retrying: connection failures, link errors,
+#timeouts, deadlocks and the general error raised by flapping servers
+TRANSIENT_ERRORS = ('08001', '08S01', '08004', 'HYT00', 'HYT01',
+                    '40001', 'HY000')
+
+#default retry / timeout / circuit breaker policy, each can be
+#overridden in the settings json or as a SqlConnect keyword argument
+DEFAULT_POLICY = {'connect_timeout': 15,     #seconds, 0 = driver default
+                  'query_timeout': 0,        #seconds, 0 = no limit
+                  'retries': 3,              #extra attempts after a failure
+                  'backoff': 0.5,            #first wait in seconds, doubled
+                  'max_backoff': 8,          #longest wait between attempts
+                  'breaker_threshold': 5,    #failures before failing fast
+                  'breaker_reset': 60}       #seconds before trying again
+
+
+#ODBC SQLSTATE codes with a likely cause added to the error message
+ERROR_HINTS = {'28000': 'Username or password problem, failed to login',
+               '08001': 'Server connection problem, not found',
+               'IM002': 'Data source name problem',
+               '42000': 'The database name in connection string is not found'}
+
+
+class CircuitOpenError(Exception):
+    '''
+    raised when the circuit breaker is open and calls fail fast
+    '''
+
+
+class CircuitBreaker:
+    '''
+    Count consecutive failures and fail fast after too many
+    CircuitBreaker.state: property, 'closed', 'open' or 'half-open'
+    CircuitBreaker.check(): function, raise CircuitOpenError when open
+    CircuitBreaker.success(): function, record a successful call
+    CircuitBreaker.failure(): function, record a failed call
+    '''
+    def __init__(self, threshold=5, reset=60):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.trips = 0
+        self.__opened = None
+
+    @property
+    def state(self):
+        if self.__opened is None:
+            return 'closed'
+        if time.monotonic() - self.__opened >= self.reset:
+            return 'half-open'
+        return 'open'
+
+    def check(self):
+        if self.state == 'open':
+            raise CircuitOpenError(f'{self.failures} consecutive failures, '
+                                   f'retry after {self.reset} seconds')
+
+    def success(self):
+        self.failures = 0
+        self.__opened = None
+
+    def failure(self):
+        self.failures += 1
+        #a failed trial call in half-open state re-opens the breaker
+        if self.failures >= self.threshold or self.state == 'half-open':
+            if self.state != 'open':
+                self.trips += 1
+            self.__opened = time.monotonic()
+
+
 class SqlConnect:
     '''
     Connect to SQL database
     SqlConnect.connection: property
+    SqlConnect.stats: property, counters for monitoring
     SqlConnect.open(): fuction, reopen db when closed
     SqlConnect.close(): function, close the active connection
+    SqlConnect.read_sql_query(): function, run a query with retries
+
+    Connecting and querying are retried with exponential backoff on
+    transient ODBC errors (TRANSIENT_ERRORS), and a circuit breaker
+    fails fast with CircuitOpenError after repeated failures.
+    See DEFAULT_POLICY for the settings and their defaults.
     '''
-    def __init__(self, config_file):
+    def __init__(self, config_file, **policy):
         self.__conf = Configuration(config_file)
-        self.__open_connection()
-            
+        self.__policy = {name: policy.get(name, self.__conf.config.get(name, value))
+                         for name, value in DEFAULT_POLICY.items()}
+        self.__breaker = CircuitBreaker(self.__policy['breaker_threshold'],
+                                        self.__policy['breaker_reset'])
+        self.__counters = {'connects': 0, 'connect_failures': 0,
+                           'queries': 0, 'query_failures': 0, 'retries': 0}
+        #connected on first use, so creating one never blocks
+        self.__connection = None
+
     def open(self):
         '''
         reopen database connection
         '''
+        #never opened
+        if self.__connection is None:
+            self.__open_connection()
+            return True
         #check if already open
         try:
             #already open
-            self.connection.cursor()
+            self.__connection.cursor()
         except Exception as e:
             #already closed
             if e.__class__ == pypyodbc.ProgrammingError and \
@@ -29,68 +119,191 @@ class SqlConnect:
             else:
                 #pass on any other exceptions
                 raise e
-                
+
         return True
-        
-            
+
+    def __is_transient(self, e):
+        '''
+        helper function: True for ODBC errors worth retrying
+        '''
+        return isinstance(e, pypyodbc.Error) and bool(e.args) and \
+               e.args[0] in TRANSIENT_ERRORS
+
+    def __with_retries(self, func, counter):
+        '''
+        helper function: call func through the circuit breaker,
+        retrying transient errors with exponential backoff
+        '''
+        attempt = 0
+        while True:
+            self.__breaker.check()
+            try:
+                result = func()
+            except Exception as e:
+                self.__counters[counter] += 1
+                #a bad query says nothing about the server, only
+                #transient errors count towards the breaker
+                if not self.__is_transient(e):
+                    raise e
+                self.__breaker.failure()
+                #the call that opens the breaker reports its own error
+                if attempt >= self.__policy['retries'] or \
+                   self.__breaker.state == 'open':
+                    raise e
+                self.__counters['retries'] += 1
+                time.sleep(min(self.__policy['backoff'] * 2 ** attempt,
+                               self.__policy['max_backoff']))
+                attempt += 1
+            else:
+                self.__breaker.success()
+                return result
+
+    def __connect(self):
+        '''
+        helper function: one connection attempt
+        '''
+        connection = pypyodbc.connect(self.__conf.connection_string,
+                                      timeout=self.__policy['connect_timeout'])
+        self.__counters['connects'] += 1
+        return connection
+
     def __open_connection(self):
         '''
         helper function
         '''
         try:
-            self.__connection = pypyodbc.connect(self.__conf.connection_string)
-            
-        except pypyodbc.DatabaseError as e:
-            error_code, error_msg = e.args
-            if error_code == '28000':
-                print('Username or password problem, failed to login.')
-            elif error_code == '08001':
-                print('Server connection problem, not found')
-            else:
-                raise e
-                
+            self.__connection = self.__with_retries(self.__connect,
+                                                    'connect_failures')
         except pypyodbc.Error as e:
-            error_code, error_msg = e.args
-            if error_code == 'IM002':
-                print('Data source name problem')
-            else:
-                raise e
-                
-        except pypyodbc.ProgrammingError as e:
-            error_code, error_msg = e.args
-            if error_code == '42000':
-                print('The database name in connection string is not found')
-            else:
-                raise e
-                
-        except Exception as e:
-            raise e            
-            
-            
-            
+            raise self.__explain(e) from e
+
+    @staticmethod
+    def __explain(e):
+        '''
+        helper function: the ODBC error with a hint on its likely cause
+        added to the message, other errors are returned unchanged
+        '''
+        if not isinstance(e, pypyodbc.Error) or len(e.args) != 2 or \
+           e.args[0] not in ERROR_HINTS:
+            return e
+        error_code, error_msg = e.args
+        return e.__class__(error_code,
+                           f'{ERROR_HINTS[error_code]}: {error_msg}')
+
     def close(self):
         '''
         close connection
         '''
+        if self.__connection is None:
+            #never opened
+            return True
         try:
             #close open connection
-            self.connection.close()
+            self.__connection.close()
         except Exception as e:
             #already closed
-            if e.__class__ == pypyodbc.ProgrammingError and \
-               e.args[0] == 'HY000':
+            if self.__connection is None or \
+               (e.__class__ == pypyodbc.ProgrammingError and \
+                e.args[0] == 'HY000'):
                pass
             #pass on any other exceptions
             else:
                 raise e
-                
+
         return True
-                
-                
-        
+
+    def __execute(self, sql, params=None):
+        '''
+        helper function: one attempt at running a query, returns
+        the cursor holding its results
+        '''
+        if self.__connection is None:
+            self.__connection = self.__connect()
+        try:
+            cursor = self.cursor()
+            if params:
+                cursor.execute(sql, params)
+            else:
+                cursor.execute(sql)
+            return cursor
+        except Exception as e:
+            #reconnect before the next attempt
+            if self.__is_transient(e):
+                self.__connection = None
+            raise e
+
+    @staticmethod
+    def __records(cursor, rows):
+        '''
+        helper function: fetched rows into a DataFrame
+        '''
+        columns = [col[0] for col in cursor.description]
+        return pd.DataFrame.from_records(rows, columns=columns)
+
+    def __chunks(self, cursor, chunksize):
+        '''
+        helper function: yield the results chunksize rows at a time
+        '''
+        try:
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                yield self.__records(cursor, rows)
+        finally:
+            cursor.close()
+
+    def read_sql_query(self, sql, params=None, chunksize=None):
+        '''
+        run a query into a DataFrame, a dropped connection is
+        reopened and the query retried on transient errors
+        the query runs with the query_timeout statement timeout
+        with chunksize an iterator of DataFrames is returned, only
+        running the query is retried, not fetching the chunks
+        '''
+        self.__counters['queries'] += 1
+        try:
+            cursor = self.__with_retries(lambda: self.__execute(sql, params),
+                                         'query_failures')
+        except pypyodbc.Error as e:
+            raise self.__explain(e) from e
+        if cursor.description is None:
+            cursor.close()
+            return iter([]) if chunksize else pd.DataFrame()
+        if chunksize:
+            return self.__chunks(cursor, chunksize)
+        try:
+            return self.__records(cursor, cursor.fetchall())
+        finally:
+            cursor.close()
+
+
+
     @property
     def connection(self):
+        '''
+        return the database connection, opened on first use
+        '''
+        if self.__connection is None:
+            self.__open_connection()
         return self.__connection
-    
+
+    @property
+    def stats(self):
+        '''
+        return the retry / circuit breaker counters in a dict
+        '''
+        return dict(self.__counters,
+                    breaker_state=self.__breaker.state,
+                    breaker_failures=self.__breaker.failures,
+                    breaker_trips=self.__breaker.trips)
+
     def cursor(self):
-        return self.__connection.cursor()
\ No newline at end of file
+        '''
+        return a new cursor with the query_timeout statement timeout
+        '''
+        cursor = self.connection.cursor()
+        if self.__policy['query_timeout']:
+            #SQL_ATTR_QUERY_TIMEOUT on the statement handle
+            cursor.set_timeout(int(self.__policy['query_timeout']))
+        return cursor
@@ -0,0 +1,249 @@
+'''
+SQL statements and result reshaping for the vendor databases
+kept free of any connection so they can be shared by the blocking
+and asyncio access modules
+'''
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from luminosity import Luminosity
+
+LOCUS_ORDER = ['A', 'B', 'C', 'DRB1', 'DRB5', 'DRB3', 'DRB4', 'DQB1', 'DPB1']
+
+ALPHA_CHAIN = r'^D[PQR]A'
+
+#Luminosity DataType name -> fusion bead value column
+FUSION_DATATYPES = {'Median': 'raw_value', 'Baseline': 'baseline_value'}
+
+#96 well plate positions in Luminex reading order
+WELLS = np.array([f'{row}{col}' for col in range(1, 13) for row in 'ABCDEFGH'])
+
+def allele_concat(fd):
+    '''
+        helper function to concat DQA-DQB and DPA-DPB
+        for fusion data, returns a Series of alleles
+    '''
+    return fd['beta'].where(fd['alpha'] == '-',
+                            fd['alpha'] + '-' + fd['beta'])
+    
+def resplit_allele(alleles):
+    '''
+        helper function to split DQA-DQB and DPA-DPB
+        or put a Null value to DRA field,
+        returns a DataFrame with alpha and beta columns
+    '''
+    parts = alleles.str.split('-', n=1, expand=True).reindex(columns=[0, 1])
+    return pd.DataFrame({'alpha': parts[0].where(parts[1].notnull(), None),
+                         'beta': parts[1].fillna(parts[0])})
+    
+    
+def locus_order(beta):
+    '''
+    helper function: assign a sorting order for each locus
+    as an ordered categorical, unknown loci are sorted last
+    '''
+    locus = beta.str.partition('*')[0]
+    return pd.Categorical(locus, categories=LOCUS_ORDER, ordered=True)
+
+
+def matchit_mfi_sql(session_id, sample_id):
+    '''
+        return the store procedure call in matchIT to extract
+        bead (antigen) and adjustn (AD-BG MFI) values
+    '''
+    return ('exec dbo.TT_Get_Adj_BG_MFI' \
+            ' \'{session_id}\', \'{sample_id}\' \
+            ').format(session_id=session_id, sample_id=sample_id)
+
+
+def fusion_mfi_sql(session_id, sample_id):
+    '''
+        return the store procedure call in fusion to extract
+        bead (antigen) and normalvalue (normalised MFI) values
+    '''
+    return ('exec dbo.tt_Get_Normal_MFI' \
+            ' \'{session_id}\', \'{sample_id}\' \
+            ').format(session_id=session_id, sample_id=sample_id)
+
+
+#bead values joined from the fusion patient/sample/well/tray tables
+FUSION_BEAD_COLUMNS = '''
+                p.patientid as patient_id
+                ,t.trayidname as session_name
+                ,s.sampleidname as sample_name      
+                ,t.catalogid as catalog_id
+                ,d.beadid as bead_id
+                ,replace(
+                    replace(
+                        convert(nvarchar(100), pd.specabbr), '-,',''
+                        ), ',-', ''
+                    ) as ab_sero
+                ,replace(
+                    replace(
+                        convert(nvarchar(100), pd.specificity), '-,', ''
+                        ), ',-', ''
+                    ) as ab_mol
+                ,d.rawdata as raw_value
+                ,d.normalvalue as baseline_value
+                ,w.WellID as well_id
+'''
+
+FUSION_BEAD_TABLES = '''
+            patient as p
+
+                join sample as s on s.PatientID = p.PatientID
+                join well as w on w.SampleID = s.SampleID
+                join tray as t on t.TrayID = w.TrayID
+                join well_detail as d on d.WellID = w.WellID
+                join product_detail as pd on pd.BeadID = d.BeadID 
+                                         and t.CatalogID = pd.CatalogID
+'''
+
+
+def catalog_filter(column, **kwargs):
+    '''
+    return the condition on a catalog id column selecting the
+    Luminex kit types given by kittype and _class, or ''
+    '''
+    kittype = kwargs.get('kittype', '').upper()
+    ab_class = kwargs.get('_class', '_')
+    if ab_class not in [1, 2, '1', '2']:
+        ab_class = '_'
+    if kittype == 'LSM':
+        return f'{column} like \'LSM%\''
+    elif kittype == 'SAB':
+        return f'{column} like \'LS{ab_class}A%\''
+    elif kittype == 'PRA':
+        return f'{column} like \'LS{ab_class}PRA%\''
+    return ''
+
+
+def fusion_bead_sql(patient_local_id, **kwargs):
+    '''
+    return the query extracting bead values from fusion
+    given a unique patient_local_id
+    '''
+    #Luminex kit types
+    kittype = catalog_filter('t.CatalogID', **kwargs)
+    if kittype:
+        kittype += ' and'
+            
+    #limit the date range of the results
+    session_date = kwargs.get('date_range', '')
+    if session_date:
+        session_date = f'and t.AddDT >= \'{session_date[0]}\' and t.AddDT < \'{session_date[1]}\''
+    
+    sql = f'''
+        select  
+{FUSION_BEAD_COLUMNS}
+        from 
+{FUSION_BEAD_TABLES}
+        where 
+            {kittype}
+            p.patientid ='{patient_local_id}'
+            {session_date}
+            
+        order by 
+
+            s.shipmentdt
+
+        '''
+
+    return sql
+
+
+def fusion_mirror_sql(watermark=None):
+    '''
+    return the query extracting bead values of all patients from
+    fusion with well id and tray AddDT, only trays added at or after
+    the watermark when given (a ? parameter), oldest first
+    '''
+    since = 'where t.AddDT >= ?' if watermark else ''
+    return f'''
+        select  
+{FUSION_BEAD_COLUMNS}
+                ,t.AddDT as add_dt
+        from 
+{FUSION_BEAD_TABLES}
+        {since}
+
+        order by 
+
+            t.AddDT
+
+        '''
+
+
+def group_matchit(md):
+    '''
+        join the alleles of each matchIT bead, alpha chain first,
+        returns lifematch values indexed by allele
+    '''
+    #put the alpha chain first within each bead before joining
+    md['chain'] = ~md['allele'].str.contains(ALPHA_CHAIN)
+    md.sort_values(by=['bead', 'chain'], kind='mergesort', inplace=True)
+    gmd = md.groupby(['bead', 'adjustn'])['allele'].agg('-'.join)
+    gmd = gmd.reset_index()
+    gmd = gmd.iloc[:, 1:].copy()
+    gmd.columns = ['lifematch', 'allele']
+    gmd.set_index('allele', inplace=True)
+    return gmd
+
+
+def group_fusion(fd):
+    '''
+        join the alpha/beta alleles of each fusion bead,
+        returns labscreen values indexed by allele
+    '''
+    fd['allele'] = allele_concat(fd)
+    gfd = fd[['allele', 'normalvalue']].copy()
+    gfd.columns = ['allele', 'labscreen']
+    gfd.set_index('allele', inplace=True)
+    return gfd
+
+
+def fusion_data_blocks(results, datatypes=None):
+    '''
+        reshape the bead values of one fusion session (one row per
+        bead per well) into Luminosity data blocks, one row per well
+        so repeats of a sample are kept, wells are ordered by fusion
+        well id and given consecutive well locations
+    '''
+    datatypes = datatypes or FUSION_DATATYPES
+
+    #one pivot turns every value column into a well x bead table
+    wide = results.pivot_table(index='well_id', columns='bead_id',
+                               values=list(datatypes.values()),
+                               aggfunc='last').sort_index()
+    samples = results.groupby('well_id')['sample_name'].first() \
+                     .reindex(wide.index).values
+
+    order = np.arange(len(samples))
+    locations = pd.Index(pd.Series(order + 1).astype(str) + ' (' \
+                         + WELLS[order % len(WELLS)] + ')', name='Location')
+
+    blocks = []
+    for column in datatypes.values():
+        block = DataFrame(wide[column].values, index=locations,
+                          columns=wide[column].columns.astype(str).tolist())
+        block.insert(0, 'Sample', samples)
+        #IS csv files close every row with Total Events and a blank cell
+        block['Total Events'] = np.nan
+        block[''] = ''
+        blocks.append(block)
+    return pd.concat(blocks, keys=list(datatypes.keys()))
+
+
+def fusion_to_luminosity(results, datatypes=None):
+    '''
+        convert fusion bead values (e.g. from read_data_from_fusion)
+        into Luminosity objects, returns a dict keyed by session name
+    '''
+    runs = {}
+    for session, session_results in results.groupby('session_name', sort=False):
+        meta = {'Session': session,
+                'TemplateName': session_results['catalog_id'].iloc[0]}
+        runs[session] = Luminosity.from_data(
+            fusion_data_blocks(session_results, datatypes),
+            meta=meta, filename=f'{session}.csv')
+    return runs